@@ -2,39 +2,58 @@ from fastapi import FastAPI, UploadFile, HTTPException, Form, File, Depends, Req
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import os
-import tempfile
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
 from dotenv import load_dotenv
 import uuid
-import re
+import string
+import io
+import hashlib
+from cachetools import TTLCache
 import logging
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import contextlib
+import itertools
+import functools
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from langchain_core.documents import Document
+from semantic_text_splitter import TextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_pinecone import PineconeVectorStore
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain.chat_models import init_chat_model
 from pinecone import Pinecone, ServerlessSpec
+from pinecone.exceptions import NotFoundException
 from security import (
-    limiter, validate_api_key, check_file_size, validate_pdf_content,
+    token_bucket, ip_token_bucket, validate_api_key, check_file_size, validate_pdf_content,
     update_usage_metrics, check_quota, RATE_LIMIT_MINUTE, api_keys, 
-    verify_firebase_token, db
+    verify_firebase_token, db, flush_usage_metrics, drain_usage_queue, redis_client
 )
-from slowapi.errors import RateLimitExceeded
-from slowapi.middleware import SlowAPIMiddleware
+from redis.exceptions import RedisError
 from firebase_admin import firestore
-from slowapi import Limiter
-from slowapi.util import get_remote_address
 # Load environment variables
 load_dotenv()
 # Initialize Firestore
 db = firestore.client()
-# Setup logging
+# Setup logging. Request handlers only enqueue records; a background
+# listener thread does the file and console writes off the request path.
+log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+log_handlers = [logging.FileHandler("api.log"), logging.StreamHandler()]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, *log_handlers)
+# The queue handler only renders the message; the listener's handlers add the
+# timestamp and level. force=True replaces the handler security.py set up.
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("api.log"), logging.StreamHandler()]
+    format="%(message)s",
+    handlers=[QueueHandler(log_queue)],
+    force=True
 )
 logger = logging.getLogger("pdf_api")
 
@@ -71,49 +90,121 @@ else:
         allow_methods=["*"],
         allow_headers=["*"],
     )
-    
-    
-app.state.limiter = limiter
-app.add_middleware(SlowAPIMiddleware)
-
-
 
-# Create a limiter based on IP address
-ip_limiter = Limiter(key_func=get_remote_address)
 
 # Initialize Groq LLM
 llm = init_chat_model("llama-3.3-70b-versatile", model_provider="groq")
 
+# Enhanced system prompt, built once for the process lifetime
+SYSTEM_MESSAGE = SystemMessage(content="""
+You have access to a PDF document. Your task is to answer the user's questions strictly based on the content of the PDF.
+If a question cannot be answered from the PDF, respond with: "The answer is not found in the document."
+Be accurate, concise, and reference relevant sections or quotes when possible. Wait for the user's question.
+""")
+
+# Improved prompt format; filled per request with format_map
+HUMAN_TEMPLATE = """CONTEXT:
+{context}
+
+QUESTION: {question}
+
+Remember: ONLY use information from the document provided. If the answer isn't in the document, say "I don't have enough information in the document to answer this question."
+"""
+
 # Initialize Pinecone client
 pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
 PINECONE_INDEX_NAME = "pdf-search"
 DIMENSION = 768
-
-# Store the current active document namespace
-CURRENT_NAMESPACE = None
+UPSERT_BATCH_SIZE = 100  # keeps each upsert request under Pinecone's 2MB limit
+UPSERT_POOL_THREADS = 30  # upserts sent with async_req=True run on this many threads
 
 # Pydantic models for request/response
 class QuestionRequest(BaseModel):
     question: str
+    namespace: str  # returned by /upload for the document being asked about
 
 class QuestionResponse(BaseModel):
     answer: str
     context: Optional[str] = None
 
+# Cache answers to repeated questions on the same document for an hour
+QA_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+# Each namespace has an upload version in Redis that is bumped whenever the
+# document is replaced. It is part of the cache key, so a re-upload handled by
+# one worker retires the answers cached by every other worker too.
+async def get_qa_version(namespace):
+    try:
+        return int(await redis_client.get(f"qa_version:{namespace}") or 0)
+    except RedisError as e:
+        # Without the version a cached answer may be stale, so don't use the cache
+        logger.warning(f"Couldn't read QA cache version for {namespace}: {str(e)}")
+        return None
+
+# Key on the namespace and its upload version plus a hash of the whitespace-
+# and case-normalized question
+def qa_cache_key(namespace, version, question):
+    normalized = " ".join(question.split()).lower()
+    return namespace, version, hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+
+# Drop cached answers for a document that is being replaced
+async def invalidate_qa_cache(namespace):
+    for key in [key for key in QA_CACHE.keys() if key[0] == namespace]:
+        QA_CACHE.pop(key, None)
+    try:
+        await redis_client.incr(f"qa_version:{namespace}")
+    except RedisError as e:
+        logger.warning(f"Couldn't bump QA cache version for {namespace}: {str(e)}")
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "environment": "production" if is_production else "development"}
 
+# Translation table for namespace names: ASCII letters and digits map to
+# themselves, every other character becomes "_". The Latin-1 range is
+# precomputed; rarer code points fall back to __missing__.
+class _NamespaceTable(dict):
+    def __missing__(self, codepoint):
+        return "_"
+
+_NAMESPACE_CHARS = set(string.ascii_letters + string.digits)
+NAMESPACE_TABLE = _NamespaceTable(
+    (c, chr(c) if chr(c) in _NAMESPACE_CHARS else "_") for c in range(256)
+)
+
 # Sanitize namespace name to avoid Pinecone errors
 def sanitize_namespace(name):
-    # Remove file extension
-    name = name.replace('.pdf', '')
-    # Replace spaces and special characters with underscores
-    sanitized = re.sub(r'[^a-zA-Z0-9]', '_', name)
-    # Ensure it's not too long (Pinecone may have limits)
-    if len(sanitized) > 50:
-        sanitized = sanitized[:50]
-    return sanitized
+    # Remove file extension, replace spaces and special characters with
+    # underscores and keep it short (Pinecone may have limits)
+    return name.replace('.pdf', '').translate(NAMESPACE_TABLE)[:50]
+
+# Split an iterable into lists of at most batch_size items
+def iter_batches(iterable, batch_size=UPSERT_BATCH_SIZE):
+    it = iter(iterable)
+    batch = list(itertools.islice(it, batch_size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(it, batch_size))
+
+# Extract the text of each PDF page into a Document, one per page
+def load_pdf_pages(pdf, source):
+    return [
+        Document(page_content=page.get_text("text"), metadata={"source": source, "page": i})
+        for i, page in enumerate(pdf)
+    ]
+
+# Split text into smaller chunks for better retrieval
+text_splitter = TextSplitter(capacity=500, overlap=100)
+
+# Split every page in one call (the Rust splitter works through the pages in
+# parallel), keeping page metadata and the chunk's offset within the page
+def split_pages(docs):
+    page_chunks = text_splitter.chunk_all_indices([doc.page_content for doc in docs])
+    return [
+        Document(page_content=piece, metadata={**doc.metadata, "start_index": start_index})
+        for doc, pieces in zip(docs, page_chunks)
+        for start_index, piece in pieces
+    ]
 
 # Ensure Pinecone index exists
 def create_index_if_not_exists():
@@ -129,62 +220,201 @@ def create_index_if_not_exists():
             spec=ServerlessSpec(cloud="aws", region="us-east-1")
         )
 
-# Check if namespace exists
-def namespace_exists(index, namespace):
-    try:
-        stats = index.describe_index_stats()
-        namespaces = stats.get("namespaces", {})
-        return namespace in namespaces
-    except Exception as e:
-        logger.error(f"Error checking namespace existence: {str(e)}")
-        return False
-
-# Initialize embeddings model
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
-
+# Long-lived Pinecone index handle (and its connection pool) that every
+# request shares, plus the embeddings model and the device it runs on. All are
+# set up in startup_event, inside each worker, so importing this module (as the
+# uvicorn supervisor does) stays cheap.
+INDEX = None
+embeddings = None
+EMBEDDING_DEVICE = None
+EMBEDDING_DTYPE = None
+# Max padded tokens (batch size x longest sequence) per forward pass
+EMBEDDING_TOKEN_BUDGET = 16384
+
+class MixedPrecisionEmbeddings(HuggingFaceEmbeddings):
+    """HuggingFaceEmbeddings that encodes under autocast on CUDA.
+
+    Matmuls run in half precision while layer norms, pooling and normalization
+    stay in FP32, so vectors match the FP32 model closely. Documents are sorted
+    by token count and packed into batches of at most EMBEDDING_TOKEN_BUDGET
+    padded tokens, so short chunks share large batches and little compute is
+    spent on padding. Callers that stream the results can pack with
+    token_batches and encode each pack with embed_batch.
+    """
+
+    def _mixed_precision(self):
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode())
+        if EMBEDDING_DEVICE == "cuda":
+            stack.enter_context(torch.autocast("cuda", dtype=EMBEDDING_DTYPE))
+        return stack
+
+    def token_batches(self, texts: List[str]) -> List[List[int]]:
+        """Pack the indices of texts into batches sorted by token count."""
+        if not texts:
+            return []
+        lengths = self._client.tokenizer(
+            [text.replace("\n", " ") for text in texts],
+            truncation=True,
+            max_length=self._client.max_seq_length,
+            return_length=True
+        )["length"]
+
+        # Walking in ascending length order, the current text is always the
+        # longest in its batch, so it sets the padded size of the batch
+        batches = [[]]
+        for i in sorted(range(len(texts)), key=lengths.__getitem__):
+            if batches[-1] and (len(batches[-1]) + 1) * lengths[i] > EMBEDDING_TOKEN_BUDGET:
+                batches.append([])
+            batches[-1].append(i)
+        return batches
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Encode one batch from token_batches as a single forward pass."""
+        # Match HuggingFaceEmbeddings preprocessing
+        texts = [text.replace("\n", " ") for text in texts]
+        encode_kwargs = {k: v for k, v in self.encode_kwargs.items() if k != "batch_size"}
+
+        with self._mixed_precision():
+            return self._client.encode(
+                texts,
+                batch_size=len(texts),
+                show_progress_bar=self.show_progress,
+                **encode_kwargs
+            ).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = [None] * len(texts)
+        for batch in self.token_batches(texts):
+            # Put vectors back in the caller's order
+            for i, vector in zip(batch, self.embed_batch([texts[i] for i in batch])):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        with self._mixed_precision():
+            return super().embed_query(text)
+
+# Load the embeddings model once, on the GPU when one is available
+def load_embeddings():
+    global embeddings, EMBEDDING_DEVICE, EMBEDDING_DTYPE
+    EMBEDDING_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+    # BF16 has FP32's range on Ampere+; older GPUs fall back to FP16
+    EMBEDDING_DTYPE = torch.bfloat16 if EMBEDDING_DEVICE == "cuda" and torch.cuda.is_bf16_supported() else torch.float16
+    embeddings = MixedPrecisionEmbeddings(
+        model_name="sentence-transformers/all-mpnet-base-v2",
+        model_kwargs={"device": EMBEDDING_DEVICE},
+        encode_kwargs={
+            "normalize_embeddings": True,
+            "convert_to_numpy": True
+        }
+    )
+    logger.info(f"Loaded embeddings model on device: {EMBEDDING_DEVICE} (autocast dtype: {EMBEDDING_DTYPE if EMBEDDING_DEVICE == 'cuda' else 'disabled'})")
+
+# All calls into the shared SentenceTransformer and its fast tokenizer go
+# through this single thread; concurrent calls from several threads can fail
+# with "Already borrowed" from the Rust tokenizer
+EMBEDDING_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embeddings")
+
+
+# Vector store wrapper for a namespace, cached so repeat questions on the same
+# document reuse it
+@functools.lru_cache(maxsize=1024)
+def get_vector_store(namespace):
+    return PineconeVectorStore(
+        embedding=embeddings,
+        index=INDEX,
+        namespace=namespace
+    )
 
+# Scalar-quantize vectors to int8 levels before upserting. Each vector is
+# scaled by its own max magnitude, which cosine similarity ignores, so queries
+# stay in FP32 and no calibration set is needed. Small integers serialize to
+# far fewer bytes than full-precision floats in the upsert payload.
+def quantize_int8(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    max_abs = np.maximum(np.abs(vectors).max(axis=1, keepdims=True), 1e-12)
+    return np.rint(vectors * (127 / max_abs)).astype(np.int8)
+
+# Embed chunks and upsert them to Pinecone as a pipeline: one producer embeds
+# batches while a consumer hands finished ones to the index's upsert pool, so
+# upload time is bounded by the slower of the two stages rather than their sum
+async def index_chunks(index, namespace, chunks):
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Queue(maxsize=4)
+
+    async def produce():
+        # Pack the whole document by token count once, so embedding batches
+        # fill the token budget; upsert batches are cut from the finished records
+        texts = [chunk.page_content for chunk in chunks]
+        packs = await loop.run_in_executor(EMBEDDING_EXECUTOR, embeddings.token_batches, texts)
+        records = []
+        for pack in packs:
+            vectors = await loop.run_in_executor(EMBEDDING_EXECUTOR, embeddings.embed_batch, [texts[i] for i in pack])
+            # Pinecone dense indexes store float32, so send the int8 levels as floats
+            vectors = quantize_int8(vectors).astype(np.float32).tolist()
+            # The chunk text is kept under "text" so PineconeVectorStore can
+            # rebuild documents on search
+            records += [
+                (str(uuid.uuid4()), vector, {**chunks[i].metadata, "text": texts[i]})
+                for i, vector in zip(pack, vectors)
+            ]
+            # Send every full upsert batch; the rest waits for the next pack
+            full = len(records) - len(records) % UPSERT_BATCH_SIZE
+            for batch in iter_batches(records[:full]):
+                await batches.put(batch)
+            records = records[full:]
+        if records:
+            await batches.put(records)
+        await batches.put(None)
+
+    async def consume():
+        # With async_req=True the call only builds the request and queues it
+        # on the index's pool_threads, so up to UPSERT_POOL_THREADS upserts
+        # are in flight while later batches are still being embedded
+        pending = []
+        while (records := await batches.get()) is not None:
+            upsert = functools.partial(index.upsert, vectors=records, namespace=namespace, async_req=True)
+            pending.append(await loop.run_in_executor(None, upsert))
+        # Wait for every upsert; get() re-raises the error of a failed one
+        await loop.run_in_executor(None, lambda: [result.get() for result in pending])
+
+    tasks = [asyncio.create_task(produce()), asyncio.create_task(consume())]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # If any stage failed, don't leave the others blocked on batches
+        for task in tasks:
+            task.cancel()
 
 @app.post("/upload")
-@limiter.limit(f"{RATE_LIMIT_MINUTE}/minute")
 async def upload_pdf(
-    request: Request,
     file: UploadFile = File(...),
-    api_key: str = Depends(validate_api_key)
+    api_key: str = Depends(token_bucket(RATE_LIMIT_MINUTE, RATE_LIMIT_MINUTE / 60, scope="upload"))
 ):
     try:
         content = await file.read()
 
         # Security checks
         check_file_size(len(content))
-        validate_pdf_content(content)
-        check_quota(api_key)
+        # The document parsed during validation is closed even if a later check fails
+        with validate_pdf_content(content) as pdf:
+            await check_quota(api_key)
 
-        # Update usage metrics
-        update_usage_metrics(api_key, len(content))
+            # Update usage metrics
+            await update_usage_metrics(api_key, len(content))
 
-        # Generate a unique namespace for this document
-        global CURRENT_NAMESPACE
-        user_id = api_keys[api_key].get("user_id", "anonymous")
-        CURRENT_NAMESPACE = f"{user_id}_{sanitize_namespace(file.filename)}"
+            # Generate a unique namespace for this document
+            user_id = api_keys[api_key].get("user_id", "anonymous")
+            namespace = f"{user_id}_{sanitize_namespace(file.filename)}"
 
-        logger.info(f"Processing PDF: {file.filename} with namespace: {CURRENT_NAMESPACE}")
+            logger.info(f"Processing PDF: {file.filename} with namespace: {namespace}")
 
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-            temp_file.write(content)
-            temp_path = temp_file.name
-
-        # Process PDF
-        docs = PyPDFLoader(temp_path).load()
+            # Extract text from the document parsed during validation
+            docs = load_pdf_pages(pdf, file.filename)
         logger.info(f"Loaded {len(docs)} pages from PDF")
 
-        # Split text into smaller chunks for better retrieval
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500,
-            chunk_overlap=100,
-            add_start_index=True
-        )
-        chunks = text_splitter.split_documents(docs)
+        chunks = split_pages(docs)
         logger.info(f"Created {len(chunks)} chunks from PDF")
 
         # Add enhanced metadata to chunks
@@ -195,44 +425,30 @@ async def upload_pdf(
             if "page" not in chunk.metadata:
                 chunk.metadata["page"] = chunk.metadata.get("page", "unknown")
 
-        # Connect to Pinecone index
-        index = pc.Index(PINECONE_INDEX_NAME)
-
-        # Only try to delete the namespace if it exists
-        if namespace_exists(index, CURRENT_NAMESPACE):
-            try:
-                index.delete(delete_all=True, namespace=CURRENT_NAMESPACE)
-                logger.info(f"Cleared namespace {CURRENT_NAMESPACE} in Pinecone index")
-            except Exception as e:
-                # Log the error but continue processing
-                logger.warning(f"Failed to delete namespace {CURRENT_NAMESPACE}: {str(e)}")
-        else:
-            logger.info(f"Namespace {CURRENT_NAMESPACE} doesn't exist yet, skipping deletion")
-
-        # Store in Pinecone with namespace
-        vector_store = PineconeVectorStore(
-            embedding=embeddings,
-            index=index,
-            namespace=CURRENT_NAMESPACE
-        )
+        # Clear any previous version of this document; a missing namespace is fine
+        try:
+            INDEX.delete(delete_all=True, namespace=namespace)
+            logger.info(f"Cleared namespace {namespace} in Pinecone index")
+        except NotFoundException:
+            logger.info(f"Namespace {namespace} doesn't exist yet, skipping deletion")
+        except Exception as e:
+            # Log the error but continue processing
+            logger.warning(f"Failed to delete namespace {namespace}: {str(e)}")
+        await invalidate_qa_cache(namespace)
 
-        ids = vector_store.add_documents(documents=chunks)
-        logger.info(f"Added {len(ids)} chunks to Pinecone namespace: {CURRENT_NAMESPACE}")
+        # Embed and store chunks in Pinecone with namespace
+        await index_chunks(INDEX, namespace, chunks)
 
-        # Cleanup
-        os.unlink(temp_path)
+        # Questions asked while indexing may have been answered from a partial
+        # document, so drop anything cached in the meantime as well
+        await invalidate_qa_cache(namespace)
+        logger.info(f"Added {len(chunks)} chunks to Pinecone namespace: {namespace}")
 
         return {
-            "message": f"PDF processed successfully. Created {len(chunks)} chunks in namespace {CURRENT_NAMESPACE}.",
-            "namespace": CURRENT_NAMESPACE
+            "message": f"PDF processed successfully. Created {len(chunks)} chunks in namespace {namespace}.",
+            "namespace": namespace
         }
 
-    except RateLimitExceeded:
-        logger.warning(f"Rate limit exceeded for API key: {api_key}")
-        raise HTTPException(
-            status_code=429,
-            detail="Rate limit exceeded. Please try again later."
-        )
     except Exception as e:
         logger.error(f"Error processing PDF: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -240,32 +456,43 @@ async def upload_pdf(
 
 
 @app.post("/ask", response_model=QuestionResponse)
-@limiter.limit(f"{RATE_LIMIT_MINUTE}/minute")
 async def ask_question(
-    request: Request,
     question: QuestionRequest,
-    api_key: str = Depends(validate_api_key)
+    api_key: str = Depends(token_bucket(RATE_LIMIT_MINUTE, RATE_LIMIT_MINUTE / 60, scope="ask"))
 ):
     try:
-        global CURRENT_NAMESPACE
-        if not CURRENT_NAMESPACE:
+        namespace = question.namespace
+        if not namespace:
             raise HTTPException(
                 status_code=400,
                 detail="No document has been uploaded yet. Please upload a PDF first."
             )
 
-        logger.info(f"Processing question: {question.question} in namespace: {CURRENT_NAMESPACE}")
+        # Namespaces are prefixed with the owner's user id; only allow your own
+        user_id = api_keys[api_key].get("user_id", "anonymous")
+        if not namespace.startswith(f"{user_id}_"):
+            raise HTTPException(
+                status_code=403,
+                detail="You don't have access to this document."
+            )
 
-        # Query vector store with the current namespace
-        index = pc.Index(PINECONE_INDEX_NAME)
-        vector_store = PineconeVectorStore(
-            embedding=embeddings,
-            index=index,
-            namespace=CURRENT_NAMESPACE
-        )
+        # Answer repeated questions from the cache
+        version = await get_qa_version(namespace)
+        cache_key = qa_cache_key(namespace, version, question.question)
+        cached_response = QA_CACHE.get(cache_key) if version is not None else None
+        if cached_response is not None:
+            logger.info(f"Answering question from cache in namespace: {namespace}")
+            return cached_response
+
+        logger.info(f"Processing question: {question.question} in namespace: {namespace}")
+
+        # Query vector store with the requested namespace
+        vector_store = get_vector_store(namespace)
 
-        # Retrieve relevant documents
-        results = vector_store.similarity_search(question.question, k=5)
+        # Embed the question on the embedding thread, then retrieve relevant documents
+        loop = asyncio.get_running_loop()
+        query_vector = await loop.run_in_executor(EMBEDDING_EXECUTOR, embeddings.embed_query, question.question)
+        results = [doc for doc, _ in vector_store.similarity_search_by_vector_with_score(query_vector, k=5)]
 
         if not results:
             return QuestionResponse(
@@ -273,32 +500,18 @@ async def ask_question(
                 context="No relevant content found in the document."
             )
 
-        # Format context with clear section markers
-        context_parts = []
+        # Format context with clear section markers, written into one buffer
+        buf = io.StringIO()
         for i, doc in enumerate(results):
             # Add document metadata to help LLM understand the source
-            metadata_str = f"[Document: {doc.metadata.get('filename', 'Unknown')}, Page: {doc.metadata.get('page', 'Unknown')}]"
-            context_parts.append(f"DOCUMENT SECTION {i+1} {metadata_str}:\n{doc.page_content}")
+            buf.write(f"\n\nDOCUMENT SECTION {i+1} [Document: {doc.metadata.get('filename', 'Unknown')}, Page: {doc.metadata.get('page', 'Unknown')}]:\n")
+            buf.write(doc.page_content)
 
-        context = "\n\n" + "\n\n".join(context_parts)
+        context = buf.getvalue()
 
-        # Enhanced system prompt
-        system_message = """
-        You have access to a PDF document. Your task is to answer the user's questions strictly based on the content of the PDF.
-        If a question cannot be answered from the PDF, respond with: "The answer is not found in the document."
-        Be accurate, concise, and reference relevant sections or quotes when possible. Wait for the user's question.
-        """
-
-        # Improved prompt format
         messages = [
-            SystemMessage(content=system_message),
-            HumanMessage(content=f"""CONTEXT:
-{context}
-
-QUESTION: {question.question}
-
-Remember: ONLY use information from the document provided. If the answer isn't in the document, say "I don't have enough information in the document to answer this question."
-""")
+            SYSTEM_MESSAGE,
+            HumanMessage(content=HUMAN_TEMPLATE.format_map({"context": context, "question": question.question}))
         ]
 
         logger.info(f"Sending prompt to LLM with context length: {len(context)}")
@@ -307,17 +520,18 @@ Remember: ONLY use information from the document provided. If the answer isn't i
         response = llm.invoke(messages)
         logger.info(f"Received response from LLM")
 
-        return QuestionResponse(
+        # Only LLM answers are cached; an empty search may just mean the upload
+        # hasn't become searchable yet
+        question_response = QuestionResponse(
             answer=response.content,
             context=context
         )
+        if version is not None:
+            QA_CACHE[cache_key] = question_response
+        return question_response
 
-    except RateLimitExceeded:
-        logger.warning(f"Rate limit exceeded for API key: {api_key}")
-        raise HTTPException(
-            status_code=429,
-            detail="Rate limit exceeded. Please try again later."
-        )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in ask_question: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -328,14 +542,12 @@ if not is_production:
     async def get_index_info(api_key: str = Depends(validate_api_key)):
         """Get information about the Pinecone index for debugging"""
         try:
-            index = pc.Index(PINECONE_INDEX_NAME)
-            stats = index.describe_index_stats()
+            stats = INDEX.describe_index_stats()
             return {
                 "index_name": PINECONE_INDEX_NAME,
                 "vector_count": stats.get("total_vector_count", 0),
                 "dimension": stats.get("dimension", DIMENSION),
-                "namespaces": stats.get("namespaces", {}),
-                "current_namespace": CURRENT_NAMESPACE
+                "namespaces": stats.get("namespaces", {})
             }
         except Exception as e:
             return {"error": str(e)}
@@ -344,10 +556,12 @@ if not is_production:
     async def clear_index(api_key: str = Depends(validate_api_key)):
         """Clear the entire Pinecone index for debugging"""
         try:
-            index = pc.Index(PINECONE_INDEX_NAME)
-            index.delete(delete_all=True)
-            global CURRENT_NAMESPACE
-            CURRENT_NAMESPACE = None
+            namespaces = INDEX.describe_index_stats().get("namespaces", {})
+            INDEX.delete(delete_all=True)
+            QA_CACHE.clear()
+            # Bump every namespace's version so other workers drop their answers too
+            for namespace in namespaces:
+                await invalidate_qa_cache(namespace)
             return {"message": "Index cleared successfully"}
         except Exception as e:
             return {"error": str(e)}
@@ -355,32 +569,40 @@ if not is_production:
 
 @app.on_event("startup")
 async def startup_event():
-    # Create Pinecone index if needed
+    global INDEX
+    log_listener.start()
+
+    # Create Pinecone index if needed and load the model in this worker
     create_index_if_not_exists()
+    INDEX = pc.Index(PINECONE_INDEX_NAME, pool_threads=UPSERT_POOL_THREADS)
+    load_embeddings()
 
-    # Load API keys from Firestore
-    try:
-        keys_ref = db.collection('api_keys').stream()
-        for key_doc in keys_ref:
-            key_data = key_doc.to_dict()
-            api_key = key_doc.id
-            api_keys[api_key] = {
-                "user_id": key_data.get('user_id'),
-                "daily_usage": key_data.get('daily_usage', 0),
-                "last_reset": datetime.fromisoformat(key_data.get('last_reset')),
-                "expires_at": datetime.fromisoformat(key_data.get('expires_at'))
-            }
-        logger.info(f"Loaded {len(api_keys)} API keys from Firestore")
-    except Exception as e:
-        logger.error(f"Error loading API keys from Firestore: {str(e)}")
+    # Persist usage metrics in the background, off the request path
+    app.state.usage_flusher = asyncio.create_task(flush_usage_metrics())
 
     logger.info("API started and connected to Pinecone index")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Stop the flusher, letting a write it has in progress finish, then write
+    # out usage updates still waiting in the queue
+    app.state.usage_flusher.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await app.state.usage_flusher
+    await drain_usage_queue()
+
+    # Flush any queued log records to disk
+    log_listener.stop()
     
 # New endpoint to create API keys with expiration
 # Replace your existing create_api_key endpoint with this:
-@app.post("/create-api-key")
-@limiter.limit(f"{RATE_LIMIT_MINUTE}/minute")  # Your existing rate limit
-@ip_limiter.limit("2/day")
+@app.post(
+    "/create-api-key",
+    dependencies=[
+        Depends(ip_token_bucket(RATE_LIMIT_MINUTE, RATE_LIMIT_MINUTE / 60, scope="create-api-key")),
+        Depends(ip_token_bucket(2, 2 / (24 * 60 * 60), scope="create-api-key-daily"))
+    ]
+)
 async def create_api_key(request: Request):
     # Get the token from the Authorization header
     auth_header = request.headers.get("Authorization")
@@ -455,4 +677,16 @@ async def create_api_key(request: Request):
         
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # uvloop (picked by loop="auto" where installed) and httptools speed up the
+    # event loop and HTTP parsing. Each worker loads its own copy of the
+    # embeddings model, so run one by default; scale with WEB_CONCURRENCY or
+    # `uvicorn main:app --workers N`.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+        backlog=2048
+    )
\ No newline at end of file
@@ -1,18 +1,22 @@
 from datetime import datetime, timedelta
 from typing import Dict, Optional
-from fastapi import HTTPException, Request, Security
+from fastapi import Depends, HTTPException, Request, Security
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import APIKeyHeader
-from slowapi import Limiter
-from slowapi.util import get_remote_address
+import redis.asyncio as redis
+from redis.exceptions import RedisError
 import os
-import PyPDF2
-from io import BytesIO
+import pymupdf
 import firebase_admin
 from firebase_admin import credentials, auth, firestore
 import logging
 from dotenv import load_dotenv
 import base64
 import json
+import hashlib
+import time
+import asyncio
+from cachetools import LRUCache, TTLCache
 # Load environment variables
 load_dotenv()
 # Setup simple logging
@@ -46,8 +50,62 @@ else:
     print("No Firebase credentials found in environment variables")
     raise ValueError("Firebase credentials not found")
 
-# Initialize rate limiter
-limiter = Limiter(key_func=get_remote_address)
+# Initialize rate limiter backed by Redis, so limits hold across workers
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Short timeouts so an unresponsive Redis fails open quickly instead of
+# stalling every request until the OS TCP timeout
+REDIS_TIMEOUT = 0.25  # seconds
+redis_client = redis.from_url(
+    REDIS_URL,
+    socket_connect_timeout=REDIS_TIMEOUT,
+    socket_timeout=REDIS_TIMEOUT
+)
+
+# Token bucket, run atomically inside Redis: refill by elapsed time, then try
+# to take one token. Returns 1 if the request is allowed, 0 otherwise.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local refill_rate = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * refill_rate)
+
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill_rate))
+return allowed
+"""
+token_bucket_script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+# Daily usage counter, shared by all workers and run atomically inside Redis:
+# seed from Firestore's values if the key is new, reset after a day, then add
+# the bytes. Returns the new usage and the last reset time.
+USAGE_SCRIPT = """
+local now = tonumber(ARGV[2])
+local usage = redis.call('HMGET', KEYS[1], 'daily_usage', 'last_reset')
+local daily_usage = tonumber(usage[1]) or tonumber(ARGV[3])
+local last_reset = tonumber(usage[2]) or tonumber(ARGV[4])
+
+if now - last_reset > 86400 then
+    daily_usage = 0
+    last_reset = now
+end
+daily_usage = daily_usage + tonumber(ARGV[1])
+
+redis.call('HSET', KEYS[1], 'daily_usage', daily_usage, 'last_reset', last_reset)
+redis.call('EXPIRE', KEYS[1], 2 * 86400)
+return {daily_usage, tostring(last_reset)}
+"""
+usage_script = redis_client.register_script(USAGE_SCRIPT)
 
 # Security constants
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
@@ -60,8 +118,18 @@ RATE_LIMIT_DAY = 1000
 # API Key header
 api_key_header = APIKeyHeader(name="X-API-Key")
 
-# Store API keys
-api_keys: Dict[str, Dict] = {}
+# Store API keys, loaded lazily from Firestore and capped to bound memory.
+# Only touched from the event loop, since cachetools caches aren't thread-safe.
+api_keys: LRUCache = LRUCache(maxsize=10_000)
+
+# Usage updates waiting to be written to Firestore by flush_usage_metrics
+USAGE_FLUSH_INTERVAL = 2  # seconds
+FIRESTORE_BATCH_LIMIT = 500  # max writes per Firestore batch
+usage_queue: asyncio.Queue = asyncio.Queue()
+
+# Cache verified Firebase tokens (keyed by token hash) to skip re-verification
+TOKEN_CACHE_TTL = 300  # 5 minutes
+verified_tokens: TTLCache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL)
 
 def is_pdf(file_content: bytes) -> bool:
     """Check if the file content is a PDF by examining the header."""
@@ -69,26 +137,36 @@ def is_pdf(file_content: bytes) -> bool:
 
 # Function to verify Firebase tokens
 def verify_firebase_token(token):
+    token_hash = hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+    # Serve from cache, but never past the token's own expiry
+    decoded_token = verified_tokens.get(token_hash)
+    if decoded_token is not None and decoded_token.get("exp", 0) > time.time():
+        return decoded_token
+
     try:
         decoded_token = auth.verify_id_token(token)
-        return decoded_token
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
 
+    verified_tokens[token_hash] = decoded_token
+    return decoded_token
 
 
-def validate_api_key(api_key: str = Security(api_key_header)) -> str:
+
+async def validate_api_key(api_key: str = Security(api_key_header)) -> str:
     # First check memory cache
-    if api_key in api_keys:
+    key_data = api_keys.get(api_key)
+    if key_data is not None:
         # Check if expired
-        if datetime.now() > api_keys[api_key].get("expires_at", datetime.max):
+        if datetime.now() > key_data.get("expires_at", datetime.max):
             logger.warning(f"Expired API key used: {api_key[:8]}...")
             raise HTTPException(status_code=401, detail="API key expired")
         return api_key
 
-    # If not in memory, check Firestore
+    # If not in memory, check Firestore without blocking the event loop
     try:
-        key_doc = db.collection('api_keys').document(api_key).get()
+        key_doc = await run_in_threadpool(db.collection('api_keys').document(api_key).get)
         if not key_doc.exists:
             logger.warning(f"Invalid API key attempt: {api_key[:8]}...")
             raise HTTPException(status_code=401, detail="Invalid API key")
@@ -113,6 +191,38 @@ def validate_api_key(api_key: str = Security(api_key_header)) -> str:
         logger.error(f"Error validating API key: {str(e)}")
         raise HTTPException(status_code=401, detail=f"Error validating API key: {str(e)}")
 
+async def take_token(bucket_key: str, capacity: int, refill_rate: float):
+    try:
+        allowed = await token_bucket_script(keys=[bucket_key], args=[capacity, refill_rate])
+    except RedisError as e:
+        # Fail open so a Redis outage doesn't take the whole API down
+        logger.error(f"Rate limiter unavailable: {str(e)}")
+        return
+
+    if not allowed:
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded. Please try again later."
+        )
+
+def token_bucket(capacity: int, refill_rate: float, scope: str):
+    """Dependency factory rate limiting per API key.
+
+    The bucket holds up to `capacity` requests and refills at `refill_rate`
+    tokens per second. The dependency returns the validated API key.
+    """
+    async def dependency(api_key: str = Depends(validate_api_key)) -> str:
+        await take_token(f"ratelimit:{scope}:{api_key}", capacity, refill_rate)
+        return api_key
+    return dependency
+
+def ip_token_bucket(capacity: int, refill_rate: float, scope: str):
+    """Dependency factory rate limiting per client IP, for unauthenticated endpoints."""
+    async def dependency(request: Request):
+        client_ip = request.client.host if request.client else "127.0.0.1"
+        await take_token(f"ratelimit:{scope}:{client_ip}", capacity, refill_rate)
+    return dependency
+
 def check_file_size(file_size: int):
     if file_size > MAX_FILE_SIZE:
         raise HTTPException(
@@ -121,6 +231,10 @@ def check_file_size(file_size: int):
         )
 
 def validate_pdf_content(file_content: bytes):
+    """Validate the uploaded PDF and return the parsed document.
+
+    The caller extracts text from the returned document, so the PDF is only parsed once.
+    """
     # Check if it's a PDF by header
     if not is_pdf(file_content):
         raise HTTPException(
@@ -128,21 +242,25 @@ def validate_pdf_content(file_content: bytes):
             detail="Invalid file type. Only PDF files are allowed."
         )
 
-    # Check page count
     try:
-        pdf = PyPDF2.PdfReader(BytesIO(file_content))
-        if len(pdf.pages) > MAX_PAGES:
-            raise HTTPException(
-                status_code=400,
-                detail=f"PDF exceeds maximum page limit of {MAX_PAGES}"
-            )
+        pdf = pymupdf.open(stream=file_content, filetype="pdf")
     except Exception as e:
         raise HTTPException(
             status_code=400,
             detail="Invalid PDF file"
         )
 
-def update_usage_metrics(api_key: str, bytes_processed: int):
+    # Check page count
+    if pdf.page_count > MAX_PAGES:
+        pdf.close()
+        raise HTTPException(
+            status_code=400,
+            detail=f"PDF exceeds maximum page limit of {MAX_PAGES}"
+        )
+
+    return pdf
+
+async def update_usage_metrics(api_key: str, bytes_processed: int):
     if api_key not in api_keys:
         # Try to get from Firestore
         key_doc = db.collection('api_keys').document(api_key).get()
@@ -160,28 +278,121 @@ def update_usage_metrics(api_key: str, bytes_processed: int):
                 "last_reset": datetime.now()
             }
 
-    # Reset daily usage if it's a new day
-    if datetime.now() - api_keys[api_key]["last_reset"] > timedelta(days=1):
-        api_keys[api_key]["daily_usage"] = 0
-        api_keys[api_key]["last_reset"] = datetime.now()
+    try:
+        daily_usage, last_reset = await usage_script(
+            keys=[f"usage:{api_key}"],
+            args=[
+                bytes_processed,
+                time.time(),
+                api_keys[api_key]["daily_usage"],
+                api_keys[api_key]["last_reset"].timestamp()
+            ]
+        )
+        api_keys[api_key]["daily_usage"] = daily_usage
+        api_keys[api_key]["last_reset"] = datetime.fromtimestamp(float(last_reset))
+        # The Redis counter is shared by every worker, so Firestore gets its total
+        update = (daily_usage, True)
+    except RedisError as e:
+        # Fall back to this worker's own count while Redis is unavailable
+        logger.warning(f"Usage counter unavailable, counting locally: {str(e)}")
+
+        # Reset daily usage if it's a new day
+        reset = datetime.now() - api_keys[api_key]["last_reset"] > timedelta(days=1)
+        if reset:
+            api_keys[api_key]["daily_usage"] = 0
+            api_keys[api_key]["last_reset"] = datetime.now()
+
+        api_keys[api_key]["daily_usage"] += bytes_processed
+        # Other workers may be counting this key too, so only send what this
+        # upload added, unless the day just started over
+        update = (api_keys[api_key]["daily_usage"], True) if reset else (bytes_processed, False)
 
-    api_keys[api_key]["daily_usage"] += bytes_processed
+    # Queue the Firestore update; flush_usage_metrics writes it in the background
+    usage_queue.put_nowait((api_key, *update, api_keys[api_key]["last_reset"]))
 
-    # Update in Firestore
+    logger.info(f"Updated usage for API key {api_key[:8]}...: {api_keys[api_key]['daily_usage']/1024/1024:.2f}MB")
+
+def write_usage_batches(updates: Dict[str, Dict]):
+    items = list(updates.items())
+    for start in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+        chunk = items[start:start + FIRESTORE_BATCH_LIMIT]
+        batch = db.batch()
+        for api_key, fields in chunk:
+            batch.update(db.collection('api_keys').document(api_key), fields)
+        try:
+            batch.commit()
+        except Exception as e:
+            # One bad document (e.g. a deleted key) fails the whole batch, so
+            # retry key by key to keep the other updates
+            logger.warning(f"Batched usage update failed, retrying per key: {str(e)}")
+            for api_key, fields in chunk:
+                try:
+                    db.collection('api_keys').document(api_key).update(fields)
+                except Exception as e:
+                    logger.error(f"Error updating usage in Firestore for {api_key[:8]}...: {str(e)}")
+
+async def drain_usage_queue():
+    """Write all queued usage updates to Firestore.
+
+    Updates are either the key's total from the shared Redis counter, which
+    replaces whatever was queued before it, or a delta from the local fallback
+    count, which is added on top. Totals are written as-is and pure deltas
+    with firestore.Increment.
+    """
+    pending: Dict[str, Dict] = {}
+    while not usage_queue.empty():
+        api_key, daily_usage, absolute, last_reset = usage_queue.get_nowait()
+        entry = pending.setdefault(api_key, {"daily_usage": 0, "absolute": False})
+        if absolute:
+            entry["daily_usage"] = daily_usage
+            entry["absolute"] = True
+        else:
+            entry["daily_usage"] += daily_usage
+        entry["last_reset"] = last_reset
+
+    if not pending:
+        return
+
+    updates = {
+        api_key: {
+            'daily_usage': entry["daily_usage"] if entry["absolute"] else firestore.Increment(entry["daily_usage"]),
+            'last_reset': entry["last_reset"].isoformat()
+        }
+        for api_key, entry in pending.items()
+    }
+    write = asyncio.ensure_future(run_in_threadpool(write_usage_batches, updates))
     try:
-        db.collection('api_keys').document(api_key).update({
-            'daily_usage': api_keys[api_key]["daily_usage"],
-            'last_reset': api_keys[api_key]["last_reset"].isoformat()
-        })
+        await asyncio.shield(write)
+    except asyncio.CancelledError:
+        # Cancelled at shutdown: finish the write already in flight so it
+        # can't race the final drain or be dropped when the loop closes
+        await asyncio.wait([write])
+        if write.exception() is not None:
+            logger.error(f"Error updating usage in Firestore: {str(write.exception())}")
+        raise
     except Exception as e:
         logger.error(f"Error updating usage in Firestore: {str(e)}")
 
-    logger.info(f"Updated usage for API key {api_key[:8]}...: {api_keys[api_key]['daily_usage']/1024/1024:.2f}MB")
+async def flush_usage_metrics():
+    """Background task that persists queued usage updates every few seconds."""
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        await drain_usage_queue()
 
-def check_quota(api_key: str):
+async def check_quota(api_key: str):
     DAILY_QUOTA = 50 * 1024 * 1024  # 50MB per day
 
-    if api_keys[api_key]["daily_usage"] > DAILY_QUOTA:
+    # Prefer the count shared by all workers; fall back to this worker's own
+    daily_usage = api_keys[api_key]["daily_usage"]
+    try:
+        usage = await redis_client.hmget(f"usage:{api_key}", "daily_usage", "last_reset")
+        if usage[0] is not None:
+            fresh = time.time() - float(usage[1]) <= 86400
+            daily_usage = int(usage[0]) if fresh else 0
+    except RedisError as e:
+        logger.warning(f"Usage counter unavailable, checking quota locally: {str(e)}")
+
+    if daily_usage > DAILY_QUOTA:
         raise HTTPException(
             status_code=429,
             detail="Daily quota exceeded"
@@ -18,6 +18,7 @@ import { AuthModal } from "./components/AuthModal";
 
 function App() {
   const [file, setFile] = useState(null);
+  const [namespace, setNamespace] = useState(null);
   const [question, setQuestion] = useState("");
   const [messages, setMessages] = useState([]);
   const [loading, setLoading] = useState(false);
@@ -154,6 +155,9 @@ function App() {
 
           if (!response.ok) throw new Error("Failed to process PDF");
 
+          const { namespace } = await response.json();
+          setNamespace(namespace);
+
           setMessages((prev) => [
             ...prev,
             {
@@ -170,6 +174,7 @@ function App() {
             },
           ]);
           setFile(null);
+          setNamespace(null);
         } finally {
           setLoading(false);
         }
@@ -180,7 +185,7 @@ function App() {
 
   const handleSubmit = async (e) => {
     e.preventDefault();
-    if (!question.trim() || !file || !user) return;
+    if (!question.trim() || !file || !namespace || !user) return;
 
     setMessages((prev) => [
       ...prev,
@@ -199,7 +204,7 @@ function App() {
           "X-API-Key": apiKey,
           "X-Device-Fingerprint": fingerprint,
         },
-        body: JSON.stringify({ question }),
+        body: JSON.stringify({ question, namespace }),
       });
 
       if (!response.ok) throw new Error("Failed to get answer");
@@ -228,6 +233,7 @@ function App() {
 
   const removeFile = () => {
     setFile(null);
+    setNamespace(null);
     setMessages([]);
   };
 